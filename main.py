@@ -1,11 +1,26 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import logging.handlers
 import os
-from typing import Dict, Deque, Optional
-from collections import defaultdict, deque
+import queue
+import re
+import time
+import weakref
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+from collections import OrderedDict, deque
 
 import httpx
+import orjson
+from cachetools import LRUCache, TTLCache
 from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import ORJSONResponse
+from starlette.background import BackgroundTask
 from starlette.responses import PlainTextResponse
-from openai import OpenAI
+from openai import AsyncOpenAI
+from pydantic import BaseModel, Field, ValidationError
+from redis.asyncio import Redis
 
 # =========================
 # Variáveis de ambiente
@@ -16,6 +31,16 @@ PHONE_NUMBER_ID = os.environ.get("WHATSAPP_PHONE_NUMBER_ID", "")
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY", "")
 MODEL_ID = os.environ.get("MODEL_ID", "llama-3.1-8b-instant")
 TEST_RECIPIENT = os.environ.get("TEST_RECIPIENT", "")  # opcional: para /ping
+APP_ENV = os.environ.get("APP_ENV", "development")
+APP_SECRET = os.environ.get("APP_SECRET", "")  # App Secret da Meta: valida X-Hub-Signature-256
+REDIS_URL = os.environ.get("REDIS_URL", "")  # opcional: histórico compartilhado entre workers
+HISTORY_MAX_USERS = int(os.environ.get("HISTORY_MAX_USERS", "10000"))  # limite do fallback em memória
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "2048"))  # tokens aproximados por usuário
+HISTORY_TTL = int(os.environ.get("HISTORY_TTL", str(7 * 24 * 3600)))  # segundos sem conversa até expirar (Redis)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()  # DEBUG inclui payloads completos
+RATE_LIMIT_MSGS = int(os.environ.get("RATE_LIMIT_MSGS", "5"))  # mensagens por janela, por usuário
+RATE_LIMIT_WINDOW = float(os.environ.get("RATE_LIMIT_WINDOW", "10"))  # segundos
+STREAM_FLUSH_CHARS = int(os.environ.get("STREAM_FLUSH_CHARS", "200"))  # tamanho mínimo de cada parte enviada
 
 if not VERIFY_TOKEN:
     raise RuntimeError("Faltou APP_VERIFY_TOKEN no ambiente.")
@@ -28,24 +53,116 @@ if not GROQ_API_KEY:
 
 SIMULATE = (WHATSAPP_TOKEN == "FAKE")
 
+
+def _env_flag(name: str, default: bool) -> bool:
+    return os.environ.get(name, "1" if default else "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+# Feature flags (comportamentos que antes variavam entre cópias do bot)
+ENABLE_BR_MOBILE_FIX = _env_flag("ENABLE_BR_MOBILE_FIX", APP_ENV != "production")  # insere '9' em celulares BR
+PREFER_WA_ID = _env_flag("PREFER_WA_ID", True)  # remetente: wa_id (E.164) antes de message.from
+ENABLE_PING = _env_flag("ENABLE_PING", True)  # expõe GET /ping
+ALLOW_UNSIGNED_WEBHOOKS = _env_flag("ALLOW_UNSIGNED_WEBHOOKS", False)  # opt-out explícito da assinatura em produção
+
+if APP_ENV == "production" and not APP_SECRET and not ALLOW_UNSIGNED_WEBHOOKS:
+    raise RuntimeError("Faltou APP_SECRET no ambiente (obrigatório em produção; ALLOW_UNSIGNED_WEBHOOKS=1 desativa).")
+
+# =========================
+# Logging (I/O em thread separada via QueueHandler/QueueListener)
+# =========================
+log = logging.getLogger("whatsapp_bot")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+
 # =========================
 # Clientes e estado
 # =========================
-client = OpenAI(base_url="https://api.groq.com/openai/v1", api_key=GROQ_API_KEY)
-app = FastAPI(title="WhatsApp LLM Bot (Groq)")
+client = AsyncOpenAI(
+    base_url="https://api.groq.com/openai/v1",
+    api_key=GROQ_API_KEY,
+    timeout=httpx.Timeout(30.0),
+    max_retries=2,
+)
+app = FastAPI(title="WhatsApp LLM Bot (Groq)", default_response_class=ORJSONResponse)
+
+HISTORY_MAX = 50  # teto de mensagens por usuário (salvaguarda; o limite real é o orçamento de tokens)
+
+# Fallback em memória quando não há REDIS_URL (um histórico por worker).
+# LRU: usuários inativos são descartados para a memória não crescer sem limite.
+history: LRUCache = LRUCache(maxsize=HISTORY_MAX_USERS)  # phone -> ConversationHistory
+
+# Token bucket por usuário (fallback em memória): phone -> (tokens, último refill, já avisado)
+buckets: LRUCache = LRUCache(maxsize=HISTORY_MAX_USERS)
+
+# IDs de mensagens já processadas (Meta reenvia webhooks); fallback em memória
+SEEN_IDS_MAX = 50_000
+SEEN_IDS_TTL = 3600  # segundos (Redis)
+seen_ids: "OrderedDict[str, None]" = OrderedDict()
+
+# Coalescência de chamadas ao LLM (mesmo usuário + mesmo texto, ex.: toque duplo em "enviar")
+_inflight: Dict[Tuple[str, str], "asyncio.Future[str]"] = {}
+DOUBLE_TAP_WINDOW = 5  # segundos: repetição do mesmo texto dentro disso é tratada como toque duplo
+recent_messages: TTLCache = TTLCache(maxsize=1000, ttl=DOUBLE_TAP_WINDOW)  # (phone, texto) recebidos há pouco
+_reply_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Tamanho máximo aceito no corpo do webhook (payloads da Meta são pequenos)
+MAX_BODY_BYTES = 65_536
 
-History = Dict[str, Deque[dict]]
-history: History = defaultdict(lambda: deque(maxlen=10))
+SYSTEM_MSG = {"role": "system", "content": "Responda em português do Brasil, de forma objetiva e útil."}
+
+# Streaming do LLM: fins de frase onde uma parte pode ser enviada
+_SENTENCE_ENDS = (".", "!", "?", "\n")
 
 GRAPH_BASE = "https://graph.facebook.com/v19.0"
+WA_MESSAGES_PATH = f"/{PHONE_NUMBER_ID}/messages"  # relativo a GRAPH_BASE
+WA_HEADERS = {
+    "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+    "Content-Type": "application/json",
+}
+
+
+# =========================
+# Ciclo de vida (cliente HTTP compartilhado)
+# =========================
+@app.on_event("startup")
+async def startup():
+    """Cria um único cliente httpx com pool de conexões (keep-alive) para a Graph API."""
+    _log_listener.start()
+    if not APP_SECRET:
+        log.warning("APP_SECRET não definido: assinatura X-Hub-Signature-256 do webhook NÃO será verificada.")
+    app.state.wa_client = httpx.AsyncClient(
+        base_url=GRAPH_BASE,
+        headers=WA_HEADERS,
+        timeout=httpx.Timeout(20.0, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        http2=True,
+    )
+    # Redis.from_url já mantém um ConnectionPool próprio
+    app.state.redis = Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.wa_client.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+    _log_listener.stop()
 
 
 # =========================
 # Utilitários
 # =========================
+_NON_DIGIT = re.compile(r"\D")
+
+
 def normalize_msisdn(raw: Optional[str]) -> str:
     """Mantém apenas dígitos do número. Ex.: '+55 (62) 99905-4475' -> '5562999054475'."""
-    return "".join(ch for ch in (raw or "") if ch.isdigit())
+    return _NON_DIGIT.sub("", raw) if raw else ""
 
 
 def fix_br_mobile_if_needed(n: str) -> str:
@@ -62,6 +179,152 @@ def fix_br_mobile_if_needed(n: str) -> str:
     return n
 
 
+def _history_key(phone: str) -> str:
+    return f"h:{phone}"
+
+
+def approx_tokens(msg: dict) -> int:
+    """Estimativa barata de tokens de uma mensagem (~4 caracteres por token + overhead do formato chat)."""
+    return len(msg.get("content") or "") // 4 + 4
+
+
+class ConversationHistory:
+    """
+    Histórico em memória limitado por tokens aproximados. Guarda trocas completas
+    (pergunta do usuário + resposta), e ao acrescentar descarta as trocas mais antigas
+    até o total caber em HISTORY_TOKEN_BUDGET (e em HISTORY_MAX mensagens) — assim nunca
+    sobra uma resposta sem a pergunta correspondente.
+    Iterar devolve as mensagens em ordem cronológica.
+    """
+
+    __slots__ = ("turns", "total", "count")
+
+    def __init__(self):
+        self.turns: Deque[Tuple[int, Tuple[dict, ...]]] = deque()
+        self.total = 0  # tokens aproximados
+        self.count = 0  # mensagens
+
+    def __iter__(self):
+        return (msg for _, turn in self.turns for msg in turn)
+
+    def add_turn(self, *msgs: dict):
+        t = sum(approx_tokens(m) for m in msgs)
+        self.turns.append((t, msgs))
+        self.total += t
+        self.count += len(msgs)
+        while self.turns and (self.total > HISTORY_TOKEN_BUDGET or self.count > HISTORY_MAX):
+            t0, old = self.turns.popleft()
+            self.total -= t0
+            self.count -= len(old)
+
+
+def get_history(phone: str) -> ConversationHistory:
+    """Histórico em memória do usuário (cria se não existir e marca como usado no LRU)."""
+    h = history.get(phone)
+    if h is None:
+        h = ConversationHistory()
+        history[phone] = h
+    return h
+
+
+async def load_history(phone: str) -> Iterable[dict]:
+    """Retorna o histórico do usuário em ordem cronológica, dentro de HISTORY_TOKEN_BUDGET."""
+    r = app.state.redis
+    if r is None:
+        return get_history(phone)
+    # Cada item da lista no Redis é uma troca completa (lista JSON de mensagens);
+    # o orçamento de tokens é aplicado na leitura, troca a troca
+    raw = await r.lrange(_history_key(phone), 0, HISTORY_MAX // 2 - 1)
+    turns: List[List[dict]] = []
+    total = 0
+    for x in raw:  # da mais recente para a mais antiga
+        turn = orjson.loads(x)
+        if not isinstance(turn, list):  # formato antigo (uma mensagem por item): para aqui
+            break
+        total += sum(approx_tokens(m) for m in turn)
+        if total > HISTORY_TOKEN_BUDGET:
+            break
+        turns.append(turn)
+    return [msg for turn in reversed(turns) for msg in turn]
+
+
+async def append_history(phone: str, *msgs: dict):
+    """Acrescenta uma troca (ex.: user + assistant) ao histórico, que é podado troca a troca."""
+    r = app.state.redis
+    if r is None:
+        get_history(phone).add_turn(*msgs)
+        return
+    key = _history_key(phone)
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.lpush(key, orjson.dumps(msgs))
+        pipe.ltrim(key, 0, HISTORY_MAX // 2 - 1)
+        pipe.expire(key, HISTORY_TTL)  # usuários inativos não acumulam chaves para sempre
+        await pipe.execute()
+
+
+async def clear_history(phone: str):
+    r = app.state.redis
+    if r is None:
+        history.pop(phone, None)
+        return
+    await r.delete(_history_key(phone))
+
+
+async def is_duplicate(message_id: str) -> bool:
+    """Marca o ID como visto e retorna True se ele já tinha sido processado."""
+    r = app.state.redis
+    if r is not None:
+        return not await r.set(f"mid:{message_id}", 1, nx=True, ex=SEEN_IDS_TTL)
+
+    if message_id in seen_ids:
+        return True
+    seen_ids[message_id] = None
+    if len(seen_ids) > SEEN_IDS_MAX:
+        seen_ids.popitem(last=False)
+    return False
+
+
+async def forget_message(message_id: str):
+    """Desfaz o is_duplicate() de uma mensagem que não chegou a ser processada."""
+    r = app.state.redis
+    if r is None:
+        seen_ids.pop(message_id, None)
+        return
+    try:
+        await r.delete(f"mid:{message_id}")
+    except Exception as e:
+        log.error("[REDIS] falha ao liberar mid %s: %r", message_id, e)
+
+
+async def allow_message(phone: str) -> Tuple[bool, bool]:
+    """
+    Rate limit por usuário: até RATE_LIMIT_MSGS mensagens a cada RATE_LIMIT_WINDOW segundos.
+    Com Redis usa janela fixa (SET NX EX + INCR numa transação), compartilhada entre workers;
+    sem Redis usa um token bucket em memória.
+    Retorna (permitido, avisar): `avisar` só é True na primeira mensagem bloqueada,
+    para o aviso ao usuário não virar uma chamada à Graph API por mensagem.
+    """
+    r = app.state.redis
+    if r is not None:
+        key = f"rl:{phone}"
+        async with r.pipeline(transaction=True) as pipe:
+            # O TTL nasce junto com a chave: nunca fica um contador sem expiração
+            pipe.set(key, 0, nx=True, ex=max(1, int(RATE_LIMIT_WINDOW)))
+            pipe.incr(key)
+            _, count = await pipe.execute()
+        return count <= RATE_LIMIT_MSGS, count == RATE_LIMIT_MSGS + 1
+
+    now = time.monotonic()
+    rate = RATE_LIMIT_MSGS / RATE_LIMIT_WINDOW
+    tokens, last, notified = buckets.get(phone, (float(RATE_LIMIT_MSGS), now, False))
+    tokens = min(float(RATE_LIMIT_MSGS), tokens + (now - last) * rate)
+    if tokens < 1:
+        buckets[phone] = (tokens, now, True)
+        return False, not notified
+    buckets[phone] = (tokens - 1, now, False)
+    return True, False
+
+
 async def send_whatsapp_text(to_phone: str, text: str):
     """
     Envia texto para a Cloud API. Não levanta exceção em 4xx para não virar 500 no webhook.
@@ -69,24 +332,18 @@ async def send_whatsapp_text(to_phone: str, text: str):
     """
     to_phone = normalize_msisdn(to_phone)
 
-    # Salvaguarda: só aplica a heurística quando SIMULATE ou app em dev.
-    # Se preferir sempre usar o número exato da allow-list, pode remover esta linha.
-    if os.environ.get("APP_ENV", "development") != "production":
+    # Salvaguarda: por padrão só aplica a heurística fora de produção (ENABLE_BR_MOBILE_FIX).
+    if ENABLE_BR_MOBILE_FIX:
         to_phone = fix_br_mobile_if_needed(to_phone)
 
     if SIMULATE:
-        print(f"[SIMULATE] -> {to_phone}: {text[:180]}")
+        log.info("[SIMULATE] -> %s: %s", to_phone, text[:180])
         return
 
     if not to_phone:
-        print("[WA SEND ERROR] Número destino vazio/ inválido.")
+        log.warning("[WA SEND ERROR] Número destino vazio/ inválido.")
         return
 
-    url = f"{GRAPH_BASE}/{PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json",
-    }
     payload = {
         "messaging_product": "whatsapp",
         "to": to_phone,
@@ -95,12 +352,15 @@ async def send_whatsapp_text(to_phone: str, text: str):
     }
 
     try:
-        async with httpx.AsyncClient(timeout=20) as http:
-            print("[WA REQUEST]", url, payload)  # log de diagnóstico
-            r = await http.post(url, headers=headers, json=payload)
-            print("[WA RESPONSE]", r.status_code, r.text)
+        log.debug("[WA REQUEST] %s %s", WA_MESSAGES_PATH, payload)  # log de diagnóstico
+        # Content-Type: application/json já vem dos headers padrão do cliente
+        r = await app.state.wa_client.post(WA_MESSAGES_PATH, content=orjson.dumps(payload))
+        if r.is_success:
+            log.info("[WA RESPONSE] %s", r.status_code)
+        else:
+            log.warning("[WA RESPONSE] %s %s", r.status_code, r.text)
     except Exception as e:
-        print("[WA EXCEPTION]", repr(e))
+        log.error("[WA EXCEPTION] %r", e)
 
 
 # =========================
@@ -125,94 +385,280 @@ async def verify_webhook(
     raise HTTPException(status_code=403, detail="Verification failed")
 
 
+# =========================
+# Payload do webhook
+# =========================
+class TextMessage(BaseModel):
+    body: str = ""
+
+
+class Message(BaseModel):
+    id: Optional[str] = None
+    from_: Optional[str] = Field(None, alias="from")
+    type: Optional[str] = None
+    text: Optional[TextMessage] = None
+
+
+class Contact(BaseModel):
+    wa_id: Optional[str] = None
+
+
+class Value(BaseModel):
+    messages: List[Message] = []
+    contacts: List[Optional[Contact]] = []  # a Meta pode mandar `null` na lista
+
+
+class Change(BaseModel):
+    value: Value = Field(default_factory=Value)
+
+
+class Entry(BaseModel):
+    changes: List[Change] = []
+
+
+class WebhookPayload(BaseModel):
+    entry: List[Entry] = []
+
+
+async def _read_body_limited(request: Request) -> bytes:
+    """Lê o corpo da requisição recusando (413) qualquer coisa acima de MAX_BODY_BYTES."""
+    if int(request.headers.get("content-length") or 0) > MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    return bytes(body)
+
+
+def verify_signature(request: Request, body: bytes):
+    """Valida o header X-Hub-Signature-256 (HMAC-SHA256 do corpo bruto com o APP_SECRET)."""
+    if not APP_SECRET:
+        return
+    expected = "sha256=" + hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    received = request.headers.get("x-hub-signature-256", "")
+    if not hmac.compare_digest(expected, received):
+        raise HTTPException(status_code=401, detail="Invalid signature")
+
+
+# =========================
+# Comandos
+# =========================
+async def _cmd_start(from_phone: str):
+    return _accepted(send_whatsapp_text, from_phone, "Olá! Sou um bot no WhatsApp usando Llama 3.1 (Groq). Mande sua pergunta.")
+
+
+async def _cmd_reset(from_phone: str):
+    await clear_history(from_phone)
+    return _accepted(send_whatsapp_text, from_phone, "Histórico limpo. Pode continuar!")
+
+
+async def _cmd_help(from_phone: str):
+    return _accepted(send_whatsapp_text, from_phone, "Comandos: /help, /start, /reset")
+
+
+COMMANDS = {
+    "/start": _cmd_start,
+    "/reset": _cmd_reset,
+    "/help": _cmd_help,
+}
+
+
 # =========================
 # Recebimento de mensagens
 # =========================
 @app.post("/webhook")
 async def incoming(request: Request):
-    data = await request.json()
-    print("==> WEBHOOK RECEBIDO:", data)
+    body = await _read_body_limited(request)
+    verify_signature(request, body)
+    log.debug("==> WEBHOOK RECEBIDO: %s", body)
 
     # Estrutura típica: entry[0].changes[0].value.messages[0]
     try:
-        entry = data.get("entry", [])[0]
-        change = entry.get("changes", [])[0]
-        value = change.get("value", {})
-    except Exception as e:
-        print("parse error:", e)
+        payload = WebhookPayload.model_validate_json(body)
+    except ValidationError as e:
+        # O texto do ValidationError inclui trechos do payload: detalhes só em DEBUG
+        log.warning("parse error: %d erro(s) em %s", e.error_count(), [err["loc"] for err in e.errors()])
+        log.debug("parse error (detalhes): %s", e)
+        return {"ok": True}
+    if not payload.entry or not payload.entry[0].changes:
         return {"ok": True}
+    value = payload.entry[0].changes[0].value
 
     # Ignora eventos que não são novas mensagens (statuses, delivery etc.)
-    messages = value.get("messages", [])
-    if not messages:
+    if not value.messages:
+        return {"ok": True}
+
+    message = value.messages[0]
+
+    # Idempotência: ignora reentregas da mesma mensagem
+    if message.id and await is_duplicate(message.id):
         return {"ok": True}
+    try:
+        return await _dispatch(value, message)
+    except Exception:
+        # Falhou antes de aceitar: libera o ID para a reentrega da Meta ser processada
+        if message.id:
+            await forget_message(message.id)
+        raise
+
 
-    message = messages[0]
-    msg_type = message.get("type")
+async def _dispatch(value: Value, message: Message):
+    """Decide a resposta para uma mensagem nova (já deduplicada) e agenda o envio."""
+    msg_type = message.type
 
     # Preferir o wa_id, que já vem padronizado em E.164 pela Cloud API
-    contacts = value.get("contacts", [])
-    wa_id = normalize_msisdn((contacts[0] or {}).get("wa_id") if contacts else None)
-    from_msg = normalize_msisdn(message.get("from"))
+    contact = value.contacts[0] if value.contacts else None
+    wa_id = normalize_msisdn(contact.wa_id if contact else None)
+    from_msg = normalize_msisdn(message.from_)
 
-    # Fonte de verdade do remetente: wa_id -> fallback para from
-    from_phone = wa_id or from_msg
+    # Fonte de verdade do remetente: wa_id -> fallback para from (invertido com PREFER_WA_ID=0)
+    from_phone = (wa_id or from_msg) if PREFER_WA_ID else (from_msg or wa_id)
 
-    print(f"Contato (wa_id)={wa_id} | from={from_msg} | usando={from_phone} | type={msg_type}")
+    log.info("Contato (wa_id)=%s | from=%s | usando=%s | type=%s", wa_id, from_msg, from_phone, msg_type)
+
+    # Rate limit antes de qualquer resposta (texto, comandos, mídia): limita os envios à Graph API
+    if from_phone:
+        allowed, notify = await allow_message(from_phone)
+        if not allowed:
+            if notify:
+                return _accepted(send_whatsapp_text, from_phone, "Muitas mensagens em sequência. Aguarde alguns segundos e tente de novo ⏳")
+            return {"ok": True}
 
     if msg_type != "text":
         if from_phone:
-            await send_whatsapp_text(
+            return _accepted(
+                send_whatsapp_text,
                 from_phone,
-                "No momento só entendo mensagens de *texto*. Envie sua pergunta 🙂"
+                "No momento só entendo mensagens de *texto*. Envie sua pergunta 🙂",
             )
         return {"ok": True}
 
-    text_body = (message.get("text") or {}).get("body", "").strip()
+    text_body = message.text.body.strip() if message.text else ""
     if not text_body:
         return {"ok": True}
 
-    # Comandos simples
-    low = text_body.lower()
-    if low.startswith("/start"):
-        await send_whatsapp_text(from_phone, "Olá! Sou um bot no WhatsApp usando Llama 3.1 (Groq). Mande sua pergunta.")
-        return {"ok": True}
-    if low.startswith("/reset"):
-        history[from_phone].clear()
-        await send_whatsapp_text(from_phone, "Histórico limpo. Pode continuar!")
-        return {"ok": True}
-    if low.startswith("/help"):
-        await send_whatsapp_text(from_phone, "Comandos: /help, /start, /reset")
-        return {"ok": True}
+    # Comandos simples (/start, /reset, /help): dispatch pelo primeiro token
+    handler = COMMANDS.get(text_body.split(None, 1)[0].lower())
+    if handler:
+        return await handler(from_phone)
+
+    # Contexto + LLM (Groq) roda depois do ack para a Meta
+    return _accepted(_handle_reply, from_phone, text_body)
 
-    # Contexto + LLM (Groq)
-    msgs = list(history[from_phone])
-    msgs.append({"role": "user", "content": text_body})
 
+def _accepted(func, *args) -> ORJSONResponse:
+    """Responde 202 imediatamente e executa `func(*args)` em background após o envio da resposta."""
+    return ORJSONResponse({"ok": True}, status_code=202, background=BackgroundTask(func, *args))
+
+
+async def _handle_reply(from_phone: str, text_body: str):
+    """
+    Responde a mensagem via LLM, coalescendo toques duplos: se o mesmo texto do mesmo usuário
+    ainda está sendo respondido, aguarda a primeira chamada em vez de chamar o Groq de novo;
+    se chegou há menos de DOUBLE_TAP_WINDOW segundos e já foi respondido com sucesso, é ignorado.
+    Respostas de um mesmo usuário são serializadas para não intercalar escritas no histórico.
+    """
+    key = (from_phone, text_body)
+    fut = _inflight.get(key)
+    if fut is not None:
+        log.info("Mensagem repetida de %s em andamento; aguardando a primeira.", from_phone)
+        await asyncio.wait([fut])
+        return
+    if key in recent_messages:
+        log.info("Mensagem repetida de %s (toque duplo) já respondida; ignorando.", from_phone)
+        return
+
+    recent_messages[key] = None
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    ok = False
     try:
-        completion = client.chat.completions.create(
+        lock = _reply_locks.get(from_phone)
+        if lock is None:
+            lock = _reply_locks[from_phone] = asyncio.Lock()
+        async with lock:
+            answer, ok = await _answer(from_phone, text_body)
+        fut.set_result(answer)
+    finally:
+        if not ok:
+            # Falhou: uma nova tentativa com o mesmo texto deve chamar o LLM de novo
+            recent_messages.pop(key, None)
+        if not fut.done():
+            fut.cancel()
+        _inflight.pop(key, None)
+
+
+async def _answer(from_phone: str, text_body: str) -> Tuple[str, bool]:
+    """
+    Consulta o LLM com o histórico curto do usuário e envia a resposta pelo WhatsApp.
+    Retorna (resposta, ok); ok é False quando o LLM falhou ou não gerou texto.
+    """
+    user_msg = {"role": "user", "content": text_body}
+    try:
+        past = await load_history(from_phone)
+    except Exception as e:
+        log.error("[HISTORY] falha ao carregar histórico de %s: %r", from_phone, e)
+        past = ()  # responde sem contexto em vez de não responder
+    llm_input = [SYSTEM_MSG, *past, user_msg]
+
+    # Streaming: envia a resposta em partes (em fim de frase, a cada ~STREAM_FLUSH_CHARS)
+    parts: List[str] = []  # resposta completa, para o histórico
+    buf: List[str] = []  # trecho ainda não enviado
+    buf_len = 0
+    failed = False
+    try:
+        stream = await client.chat.completions.create(
             model=MODEL_ID,
-            messages=[{"role": "system", "content": "Responda em português do Brasil, de forma objetiva e útil."}] + msgs,
+            messages=llm_input,
             temperature=0.6,
             max_tokens=512,
+            stream=True,
         )
-        answer = completion.choices[0].message.content or "Desculpe, não consegui responder agora."
+        async for chunk in stream:
+            delta = (chunk.choices[0].delta.content or "") if chunk.choices else ""
+            if not delta:
+                continue
+            parts.append(delta)
+            buf.append(delta)
+            buf_len += len(delta)
+            if buf_len >= STREAM_FLUSH_CHARS and delta.rstrip(" ").endswith(_SENTENCE_ENDS):
+                await send_whatsapp_text(from_phone, "".join(buf).strip())
+                buf.clear()
+                buf_len = 0
     except Exception as e:
-        print("Erro no LLM:", repr(e))
-        answer = "Ops! Tive um problema ao falar com o modelo. Tente novamente em alguns segundos."
-
-    # Persiste histórico curto
-    history[from_phone].append({"role": "user", "content": text_body})
-    history[from_phone].append({"role": "assistant", "content": answer})
-
-    await send_whatsapp_text(from_phone, answer)
-    return {"ok": True}
+        log.error("Erro no LLM: %r", e)
+        failed = True
+
+    rest = "".join(buf).strip()
+    if rest:
+        await send_whatsapp_text(from_phone, rest)
+
+    answer = "".join(parts).strip()
+    if failed:
+        error_msg = "Ops! Tive um problema ao falar com o modelo. Tente novamente em alguns segundos."
+        await send_whatsapp_text(from_phone, error_msg)
+        answer = answer or error_msg
+    elif not answer:
+        answer = "Desculpe, não consegui responder agora."
+        await send_whatsapp_text(from_phone, answer)
+
+    # Persiste histórico curto (a resposta já foi enviada: falha aqui só é logada)
+    try:
+        await append_history(
+            from_phone,
+            user_msg,
+            {"role": "assistant", "content": answer},
+        )
+    except Exception as e:
+        log.error("[HISTORY] falha ao salvar histórico de %s: %r", from_phone, e)
+    return answer, not failed and bool(parts)
 
 
 # =========================
 # Teste de envio independente do webhook
 # =========================
-@app.get("/ping")
 async def ping():
     """
     Envia 'pong 🏓' para TEST_RECIPIENT definido no ambiente.
@@ -225,3 +671,7 @@ async def ping():
         }
     await send_whatsapp_text(TEST_RECIPIENT, "pong 🏓")
     return {"ok": True}
+
+
+if ENABLE_PING:
+    app.add_api_route("/ping", ping, methods=["GET"])
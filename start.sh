@@ -0,0 +1,19 @@
+#!/usr/bin/env sh
+# Sobe o uvicorn com N workers.
+# Prioridade: UVICORN_WORKERS > WEB_CONCURRENCY > padrão.
+# Padrão: 1 worker sem REDIS_URL (histórico, dedup e rate limit ficam em memória,
+# separados por worker); com REDIS_URL, 2 * núcleos + 1.
+# Obs.: nproc enxerga os núcleos do host, não a cota do container — em instâncias
+# pequenas defina WEB_CONCURRENCY explicitamente.
+set -e
+
+if [ -n "$REDIS_URL" ]; then
+    DEFAULT_WORKERS=$((2 * $(nproc) + 1))
+else
+    DEFAULT_WORKERS=1
+fi
+
+WORKERS="${UVICORN_WORKERS:-${WEB_CONCURRENCY:-$DEFAULT_WORKERS}}"
+
+exec uvicorn main:app --host 0.0.0.0 --port "${PORT:-8000}" --workers "$WORKERS" \
+    --loop uvloop --http httptools